@@ -1,10 +1,19 @@
 import json
 import os
+import re
 import jwt
+import time
 import hashlib
 import secrets
 from datetime import datetime, timedelta
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('DATABASE_REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_LAG_CHECK_INTERVAL = 10
+REPLICA_CONNECT_TIMEOUT = 2
+
+_replica_lagging_until = 0.0
+_replica_healthy_until = 0.0
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -19,7 +28,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token, X-Min-Lsn',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
@@ -33,9 +42,12 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         if action == 'oauth_callback':
             return handle_oauth_callback(body_data)
         elif action == 'verify_token':
-            return verify_token(body_data)
+            headers = event.get('headers', {})
+            return verify_token(body_data, headers.get('X-Min-Lsn') or headers.get('x-min-lsn'))
         elif action == 'logout':
             return logout_user()
+        elif action == 'reconcile_referral_earnings':
+            return reconcile_referral_earnings(body_data)
     
     return {
         'statusCode': 405,
@@ -84,8 +96,22 @@ def handle_oauth_callback(data: Dict[str, Any]) -> Dict[str, Any]:
             )
             user = cursor.fetchone()
             user_id, user_email, user_name, user_avatar, ref_code, ref_earnings, discount_used, created_at = user
+            
+            inviter_code = data.get('referral_code')
+            if inviter_code:
+                cursor.execute("SELECT id FROM users WHERE referral_code = %s", (inviter_code,))
+                referrer = cursor.fetchone()
+                if referrer and referrer[0] != user_id:
+                    cursor.execute(
+                        "INSERT INTO referrals (referrer_id, referred_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+                        (referrer[0], user_id)
+                    )
+            
             conn.commit()
         
+        cursor.execute("SELECT pg_current_wal_lsn()")
+        write_lsn = cursor.fetchone()[0]
+        
         jwt_secret = os.environ.get('JWT_SECRET', 'default_secret_key_change_me')
         token = jwt.encode({
             'user_id': user_id,
@@ -95,7 +121,12 @@ def handle_oauth_callback(data: Dict[str, Any]) -> Dict[str, Any]:
         
         return {
             'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Expose-Headers': 'X-Write-Lsn',
+                'X-Write-Lsn': write_lsn
+            },
             'body': json.dumps({
                 'token': token,
                 'user': {
@@ -115,8 +146,7 @@ def handle_oauth_callback(data: Dict[str, Any]) -> Dict[str, Any]:
         cursor.close()
         conn.close()
 
-def verify_token(data: Dict[str, Any]) -> Dict[str, Any]:
-    import psycopg2
+def verify_token(data: Dict[str, Any], min_lsn: Optional[str] = None) -> Dict[str, Any]:
     
     token = data.get('token')
     if not token:
@@ -132,17 +162,11 @@ def verify_token(data: Dict[str, Any]) -> Dict[str, Any]:
         payload = jwt.decode(token, jwt_secret, algorithms=['HS256'])
         user_id = payload['user_id']
         
-        dsn = os.environ.get('DATABASE_URL')
-        conn = psycopg2.connect(dsn)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "SELECT id, email, name, avatar_url, referral_code, referral_earnings, first_order_discount_used, created_at FROM users WHERE id = %s",
-            (user_id,)
-        )
-        user = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        user = fetch_user(connect_for_read(min_lsn), user_id)
+        if not user and os.environ.get('DATABASE_REPLICA_URL'):
+            # Пользователь мог только что зарегистрироваться и еще не доехать до реплики
+            import psycopg2
+            user = fetch_user(psycopg2.connect(os.environ.get('DATABASE_URL')), user_id)
         
         if not user:
             return {
@@ -187,6 +211,122 @@ def verify_token(data: Dict[str, Any]) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
 
+def connect_for_read(min_lsn: Optional[str] = None) -> Any:
+    '''
+    Подключение для чтения: реплика DATABASE_REPLICA_URL, если она не отстает,
+    иначе основная БД. min_lsn - позиция WAL последней записи клиента (X-Min-Lsn)
+    Результат проверки отставания кэшируется на REPLICA_LAG_CHECK_INTERVAL; без min_lsn
+    в это время реплика отдается без лишнего запроса
+    '''
+    import psycopg2
+    global _replica_lagging_until, _replica_healthy_until
+    
+    replica_dsn = os.environ.get('DATABASE_REPLICA_URL')
+    if min_lsn and not re.fullmatch(r'[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}', min_lsn):
+        min_lsn = None
+    
+    if replica_dsn and time.monotonic() >= _replica_lagging_until:
+        try:
+            conn = psycopg2.connect(replica_dsn, connect_timeout=REPLICA_CONNECT_TIMEOUT)
+        except psycopg2.Error:
+            conn = None
+            _replica_lagging_until = time.monotonic() + REPLICA_LAG_CHECK_INTERVAL
+        
+        if conn:
+            if not min_lsn and time.monotonic() < _replica_healthy_until:
+                return conn
+            
+            # Без работающего WAL receiver равенство receive/replay ничего не говорит об отставании:
+            # такая реплика считается отстающей (NULL). Зависший приемник завершается
+            # по wal_receiver_timeout и тоже попадает в эту ветку
+            try:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT CASE WHEN NOT EXISTS (
+                                    SELECT 1 FROM pg_stat_wal_receiver WHERE COALESCE(status, 'streaming') = 'streaming'
+                                ) THEN NULL
+                                WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                                ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END,
+                           %s::pg_lsn IS NULL OR pg_last_wal_replay_lsn() >= %s::pg_lsn
+                """, (min_lsn, min_lsn))
+                lag, caught_up = cursor.fetchone()
+                cursor.close()
+            except psycopg2.Error:
+                lag, caught_up = None, False
+            
+            lagging = lag is None or lag > REPLICA_MAX_LAG_SECONDS
+            if not lagging:
+                _replica_healthy_until = time.monotonic() + REPLICA_LAG_CHECK_INTERVAL
+                if caught_up:
+                    return conn
+            
+            conn.close()
+            if lagging:
+                _replica_healthy_until = 0.0
+                _replica_lagging_until = time.monotonic() + REPLICA_LAG_CHECK_INTERVAL
+    
+    return psycopg2.connect(os.environ.get('DATABASE_URL'))
+
+def fetch_user(conn: Any, user_id: int) -> Optional[tuple]:
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "SELECT id, email, name, avatar_url, referral_code, referral_earnings, first_order_discount_used, created_at FROM users WHERE id = %s",
+            (user_id,)
+        )
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+        conn.close()
+
+def reconcile_referral_earnings(data: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Сверка users.referral_earnings с журналом начислений
+    Запускается периодически, исправляет расхождения
+    '''
+    import psycopg2
+    
+    admin_secret = os.environ.get('ADMIN_SECRET')
+    if not admin_secret or data.get('admin_key') != admin_secret:
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Forbidden'}),
+            'isBase64Encoded': False
+        }
+    
+    dsn = os.environ.get('DATABASE_URL')
+    conn = psycopg2.connect(dsn)
+    cursor = conn.cursor()
+    
+    try:
+        # Блокируем новые начисления на время сверки, иначе инкремент из параллельной транзакции может потеряться
+        cursor.execute("LOCK TABLE referral_earnings_ledger IN SHARE MODE")
+        cursor.execute("""
+            UPDATE users u
+            SET referral_earnings = COALESCE(l.total, 0)
+            FROM users src
+            LEFT JOIN (
+                SELECT referrer_id, SUM(amount) AS total
+                FROM referral_earnings_ledger
+                GROUP BY referrer_id
+            ) l ON l.referrer_id = src.id
+            WHERE u.id = src.id
+              AND COALESCE(u.referral_earnings, 0) <> COALESCE(l.total, 0)
+        """)
+        fixed = cursor.rowcount
+        conn.commit()
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': True, 'fixed': fixed}),
+            'isBase64Encoded': False
+        }
+    finally:
+        cursor.close()
+        conn.close()
+
 def logout_user() -> Dict[str, Any]:
     return {
         'statusCode': 200,
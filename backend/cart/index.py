@@ -1,7 +1,42 @@
 import json
 import os
+import re
+import math
+import gzip
+import time
+import base64
 import psycopg2
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('DATABASE_REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_LAG_CHECK_INTERVAL = 10
+REPLICA_CONNECT_TIMEOUT = 2
+COMPRESSION_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+CART_ITEM_FIELDS = ('id', 'product_id', 'quantity', 'name', 'price', 'image_url', 'total')
+RATE_LIMIT_SCOPE = 'cart'
+RATE_LIMIT_USER = (float(os.environ.get('RATE_LIMIT_CART_USER_PER_SECOND', '2')), float(os.environ.get('RATE_LIMIT_CART_USER_BURST', '20')))
+RATE_LIMIT_IP = (float(os.environ.get('RATE_LIMIT_CART_IP_PER_SECOND', '5')), float(os.environ.get('RATE_LIMIT_CART_IP_BURST', '50')))
+LOCAL_BUCKETS_MAX = 10000
+DB_POOL_SIZE = 2
+DB_CONNECT_TIMEOUT = 5
+DB_IDLE_CHECK_SECONDS = 30
+DB_ACQUIRE_BUDGET_SECONDS = float(os.environ.get('DB_ACQUIRE_BUDGET_SECONDS', '0.5'))
+DB_SHED_WINDOW_SECONDS = 5
+DB_SHED_RETRY_AFTER = 2
+
+_replica_lagging_until = 0.0
+_replica_healthy_until = 0.0
+_local_buckets: Dict[str, tuple] = {}
+_idle_connections: Dict[str, List[tuple]] = {}
+_connection_dsn: Dict[int, str] = {}
+_acquire_wait = {'average': 0.0, 'sampled_at': 0.0}
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -16,7 +51,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token, X-Min-Lsn',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
@@ -43,8 +78,13 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
+    if method in ('POST', 'DELETE'):
+        rejection = admission_control(event, user_id)
+        if rejection:
+            return rejection
+    
     if method == 'GET':
-        return get_cart(user_id)
+        return get_cart(user_id, event)
     elif method == 'POST':
         body_data = json.loads(event.get('body', '{}'))
         return add_to_cart(user_id, body_data)
@@ -68,9 +108,281 @@ def verify_user_token(token: str) -> int:
     except:
         return None
 
-def get_cart(user_id: int) -> Dict[str, Any]:
-    dsn = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(dsn)
+def acquire_connection(dsn: Optional[str] = None, connect_timeout: float = DB_CONNECT_TIMEOUT) -> Any:
+    '''
+    Соединение из пула экземпляра функции (или новое, если свободных нет)
+    Для сброса нагрузки учитывается только время успешного получения соединения с основной БД
+    '''
+    primary_dsn = os.environ.get('DATABASE_URL')
+    dsn = dsn or primary_dsn
+    started = time.monotonic()
+    idle = _idle_connections.get(dsn, [])
+    conn = None
+    
+    while idle and conn is None:
+        candidate, released_at = idle.pop()
+        if started - released_at > DB_IDLE_CHECK_SECONDS:
+            try:
+                check = candidate.cursor()
+                check.execute("SELECT 1")
+                check.close()
+                candidate.rollback()
+            except psycopg2.Error:
+                _connection_dsn.pop(id(candidate), None)
+                candidate.close()
+                continue
+        conn = candidate
+    
+    if conn is None:
+        conn = psycopg2.connect(dsn, connect_timeout=connect_timeout)
+        _connection_dsn[id(conn)] = dsn
+    
+    if dsn == primary_dsn:
+        _acquire_wait['average'] = _acquire_wait['average'] * 0.8 + (time.monotonic() - started) * 0.2
+        _acquire_wait['sampled_at'] = time.monotonic()
+    
+    return conn
+
+def release_connection(conn: Any) -> None:
+    dsn = _connection_dsn.get(id(conn))
+    
+    if not conn.closed and dsn:
+        try:
+            conn.rollback()
+            idle = _idle_connections.setdefault(dsn, [])
+            if len(idle) < DB_POOL_SIZE:
+                idle.append((conn, time.monotonic()))
+                return
+        except psycopg2.Error:
+            pass
+    
+    _connection_dsn.pop(id(conn), None)
+    conn.close()
+
+def is_overloaded() -> bool:
+    recent = time.monotonic() - _acquire_wait['sampled_at'] < DB_SHED_WINDOW_SECONDS
+    return recent and _acquire_wait['average'] > DB_ACQUIRE_BUDGET_SECONDS
+
+def get_client_ip(event: Dict[str, Any]) -> Optional[str]:
+    identity = (event.get('requestContext') or {}).get('identity') or {}
+    if identity.get('sourceIp'):
+        return identity['sourceIp']
+    
+    headers = event.get('headers', {})
+    forwarded = headers.get('X-Forwarded-For') or headers.get('x-forwarded-for')
+    return forwarded.split(',')[0].strip() if forwarded else None
+
+def take_local_token(key: str, rate: float, burst: float) -> float:
+    now = time.monotonic()
+    if len(_local_buckets) > LOCAL_BUCKETS_MAX:
+        _local_buckets.clear()
+    
+    tokens, updated_at = _local_buckets.get(key, (burst, now))
+    tokens = min(burst, tokens + (now - updated_at) * rate)
+    
+    if tokens >= 1:
+        _local_buckets[key] = (tokens - 1, now)
+        return 0.0
+    
+    _local_buckets[key] = (tokens, now)
+    return (1 - tokens) / rate
+
+def take_shared_tokens(limits: List[tuple]) -> float:
+    conn = acquire_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute(
+            "SELECT GREATEST(" + ", ".join(["take_rate_limit_token(%s, %s, %s)"] * len(limits)) + ")",
+            [value for limit in limits for value in limit]
+        )
+        retry_after = cursor.fetchone()[0]
+        conn.commit()
+        return retry_after
+    finally:
+        cursor.close()
+        release_connection(conn)
+
+def admission_control(event: Dict[str, Any], user_id: int) -> Optional[Dict[str, Any]]:
+    '''
+    Ограничение частоты запросов по пользователю и IP (token bucket) и сброс нагрузки
+    Сначала проверяется корзина в памяти экземпляра, затем общая корзина в БД
+    '''
+    if is_overloaded():
+        return {
+            'statusCode': 503,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*',
+                'Retry-After': str(DB_SHED_RETRY_AFTER)
+            },
+            'body': json.dumps({'error': 'Service overloaded, try again later'}),
+            'isBase64Encoded': False
+        }
+    
+    limits = [(f'{RATE_LIMIT_SCOPE}:user:{user_id}',) + RATE_LIMIT_USER]
+    client_ip = get_client_ip(event)
+    if client_ip:
+        limits.append((f'{RATE_LIMIT_SCOPE}:ip:{client_ip}',) + RATE_LIMIT_IP)
+    
+    retry_after = max(take_local_token(*limit) for limit in limits)
+    
+    if not retry_after:
+        try:
+            retry_after = take_shared_tokens(limits)
+        except psycopg2.Error:
+            retry_after = 0
+    
+    if retry_after:
+        return {
+            'statusCode': 429,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*',
+                'Retry-After': str(math.ceil(retry_after))
+            },
+            'body': json.dumps({'error': 'Too many requests'}),
+            'isBase64Encoded': False
+        }
+    
+    return None
+
+def connect_for_read(min_lsn: Optional[str] = None) -> Any:
+    '''
+    Подключение для чтения: реплика DATABASE_REPLICA_URL, если она не отстает,
+    иначе основная БД. min_lsn - позиция WAL последней записи клиента (X-Min-Lsn)
+    Результат проверки отставания кэшируется на REPLICA_LAG_CHECK_INTERVAL; без min_lsn
+    в это время реплика отдается без лишнего запроса
+    '''
+    global _replica_lagging_until, _replica_healthy_until
+    
+    replica_dsn = os.environ.get('DATABASE_REPLICA_URL')
+    if min_lsn and not re.fullmatch(r'[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}', min_lsn):
+        min_lsn = None
+    
+    if replica_dsn and time.monotonic() >= _replica_lagging_until:
+        try:
+            conn = acquire_connection(replica_dsn, REPLICA_CONNECT_TIMEOUT)
+        except psycopg2.Error:
+            conn = None
+            _replica_lagging_until = time.monotonic() + REPLICA_LAG_CHECK_INTERVAL
+        
+        if conn:
+            if not min_lsn and time.monotonic() < _replica_healthy_until:
+                return conn
+            
+            # Без работающего WAL receiver равенство receive/replay ничего не говорит об отставании:
+            # такая реплика считается отстающей (NULL). Зависший приемник завершается
+            # по wal_receiver_timeout и тоже попадает в эту ветку
+            try:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT CASE WHEN NOT EXISTS (
+                                    SELECT 1 FROM pg_stat_wal_receiver WHERE COALESCE(status, 'streaming') = 'streaming'
+                                ) THEN NULL
+                                WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                                ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END,
+                           %s::pg_lsn IS NULL OR pg_last_wal_replay_lsn() >= %s::pg_lsn
+                """, (min_lsn, min_lsn))
+                lag, caught_up = cursor.fetchone()
+                cursor.close()
+            except psycopg2.Error:
+                lag, caught_up = None, False
+            
+            lagging = lag is None or lag > REPLICA_MAX_LAG_SECONDS
+            if not lagging:
+                _replica_healthy_until = time.monotonic() + REPLICA_LAG_CHECK_INTERVAL
+                if caught_up:
+                    return conn
+            
+            release_connection(conn)
+            if lagging:
+                _replica_healthy_until = 0.0
+                _replica_lagging_until = time.monotonic() + REPLICA_LAG_CHECK_INTERVAL
+    
+    return acquire_connection()
+
+def parse_fields(params: Dict[str, Any], allowed: tuple) -> Optional[tuple]:
+    requested = [field.strip() for field in (params.get('fields') or '').split(',')]
+    fields = tuple(field for field in requested if field in allowed)
+    return fields or None
+
+def project(rows: List[Dict[str, Any]], fields: Optional[tuple]) -> List[Dict[str, Any]]:
+    if not fields:
+        return rows
+    return [{field: row[field] for field in fields} for row in rows]
+
+def serialize_body(payload: Dict[str, Any]) -> bytes:
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def negotiate_encoding(event: Dict[str, Any]) -> Optional[str]:
+    headers = event.get('headers') or {}
+    accept = headers.get('Accept-Encoding') or headers.get('accept-encoding') or ''
+    
+    accepted = {}
+    for part in accept.split(','):
+        name, _, params = part.partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    
+    for encoding in ('br', 'gzip'):
+        if encoding == 'br' and brotli is None:
+            continue
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+def compress_body(raw: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(raw, quality=BROTLI_QUALITY)
+    return gzip.compress(raw, compresslevel=GZIP_LEVEL, mtime=0)
+
+def build_response(event: Dict[str, Any], body: bytes, variants: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    '''
+    Ответ 200 с JSON-телом, сжатым по Accept-Encoding (br/gzip), если тело больше порога
+    variants - кэш уже сжатых вариантов тела, дополняется при промахе
+    '''
+    headers = {
+        'Content-Type': 'application/json; charset=utf-8',
+        'Access-Control-Allow-Origin': '*',
+        'Vary': 'Accept-Encoding'
+    }
+    encoding = negotiate_encoding(event) if len(body) >= COMPRESSION_MIN_BYTES else None
+    
+    if not encoding:
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': body.decode('utf-8'),
+            'isBase64Encoded': False
+        }
+    
+    if variants is not None and encoding in variants:
+        encoded = variants[encoding]
+    else:
+        encoded = base64.b64encode(compress_body(body, encoding)).decode('ascii')
+        if variants is not None:
+            variants[encoding] = encoded
+    
+    headers['Content-Encoding'] = encoding
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': encoded,
+        'isBase64Encoded': True
+    }
+
+def get_cart(user_id: int, event: Dict[str, Any]) -> Dict[str, Any]:
+    headers = event.get('headers', {})
+    fields = parse_fields(event.get('queryStringParameters') or {}, CART_ITEM_FIELDS)
+    
+    conn = connect_for_read(headers.get('X-Min-Lsn') or headers.get('x-min-lsn'))
     cursor = conn.cursor()
     
     try:
@@ -98,19 +410,14 @@ def get_cart(user_id: int) -> Dict[str, Any]:
                 'total': item_total
             })
         
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'items': cart_items,
-                'total': total,
-                'count': len(cart_items)
-            }),
-            'isBase64Encoded': False
-        }
+        return build_response(event, serialize_body({
+            'items': project(cart_items, fields),
+            'total': total,
+            'count': len(cart_items)
+        }))
     finally:
         cursor.close()
-        conn.close()
+        release_connection(conn)
 
 def add_to_cart(user_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
     product_id = data.get('product_id')
@@ -124,8 +431,7 @@ def add_to_cart(user_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
-    dsn = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(dsn)
+    conn = acquire_connection()
     cursor = conn.cursor()
     
     try:
@@ -145,15 +451,23 @@ def add_to_cart(user_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
         
         conn.commit()
         
+        cursor.execute("SELECT pg_current_wal_lsn()")
+        write_lsn = cursor.fetchone()[0]
+        
         return {
             'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Expose-Headers': 'X-Write-Lsn',
+                'X-Write-Lsn': write_lsn
+            },
             'body': json.dumps({'success': True, 'message': 'Added to cart'}),
             'isBase64Encoded': False
         }
     finally:
         cursor.close()
-        conn.close()
+        release_connection(conn)
 
 def remove_from_cart(user_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
     cart_item_id = data.get('cart_item_id')
@@ -166,20 +480,27 @@ def remove_from_cart(user_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
-    dsn = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(dsn)
+    conn = acquire_connection()
     cursor = conn.cursor()
     
     try:
         cursor.execute("DELETE FROM cart WHERE id = %s AND user_id = %s", (cart_item_id, user_id))
         conn.commit()
         
+        cursor.execute("SELECT pg_current_wal_lsn()")
+        write_lsn = cursor.fetchone()[0]
+        
         return {
             'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Expose-Headers': 'X-Write-Lsn',
+                'X-Write-Lsn': write_lsn
+            },
             'body': json.dumps({'success': True, 'message': 'Removed from cart'}),
             'isBase64Encoded': False
         }
     finally:
         cursor.close()
-        conn.close()
+        release_connection(conn)
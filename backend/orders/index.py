@@ -1,8 +1,101 @@
 import json
 import os
+import asyncio
+import io
+import re
+import math
+import csv
+import time
+import gzip
+import base64
+import tempfile
 import psycopg2
-from typing import Dict, Any
-from datetime import datetime
+from psycopg2 import sql
+from typing import Dict, Any, List, Optional
+from datetime import datetime, date, timedelta
+from decimal import Decimal
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+REFERRAL_REWARD_RATE = 0.05
+ORDERS_PAGE_SIZE = 20
+ORDERS_PAGE_SIZE_MAX = 100
+ORDERS_MIGRATION_BATCH_SIZE = 5000
+ORDERS_ARCHIVE_AFTER_MONTHS = 12
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('DATABASE_REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_LAG_CHECK_INTERVAL = 10
+REPLICA_CONNECT_TIMEOUT = 2
+COMPRESSION_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+ORDER_FIELDS = ('id', 'total_amount', 'discount_amount', 'final_amount', 'payment_method', 'payment_status', 'status', 'created_at', 'items')
+RATE_LIMIT_SCOPE = 'orders'
+RATE_LIMIT_USER = (float(os.environ.get('RATE_LIMIT_ORDERS_USER_PER_SECOND', '0.2')), float(os.environ.get('RATE_LIMIT_ORDERS_USER_BURST', '5')))
+RATE_LIMIT_IP = (float(os.environ.get('RATE_LIMIT_ORDERS_IP_PER_SECOND', '1')), float(os.environ.get('RATE_LIMIT_ORDERS_IP_BURST', '20')))
+LOCAL_BUCKETS_MAX = 10000
+DB_POOL_SIZE = 2
+DB_CONNECT_TIMEOUT = 5
+DB_IDLE_CHECK_SECONDS = 30
+DB_ACQUIRE_BUDGET_SECONDS = float(os.environ.get('DB_ACQUIRE_BUDGET_SECONDS', '0.5'))
+DB_SHED_WINDOW_SECONDS = 5
+DB_SHED_RETRY_AFTER = 2
+SALES_REPORT_DEFAULT_DAYS = 30
+SALES_ROLLUP_REFRESH_DAYS = 7
+SALES_EXPORT_CHUNK_SIZE = 2000
+SALES_EXPORT_MAX_ROWS = 100000
+SALES_EXPORT_MAX_BYTES = 2000000
+SALES_EXPORT_FLUSH_ROWS = 500
+FIRST_ORDER_DISCOUNT_RATE = 0.20
+ORDERS_ASYNC = os.environ.get('ORDERS_ASYNC') == '1'
+ASYNC_POOL_MIN_SIZE = 1
+ASYNC_POOL_MAX_SIZE = 4
+
+PAYMENT_INFO = {
+    'sberbank': {
+        'card_number': '2202 2083 9585 3485',
+        'recipient': 'Никита Владимирович Т.',
+        'bank': 'Сбербанк'
+    },
+    'sbp': {
+        'phone': '+7 (XXX) XXX-XX-XX',
+        'recipient': 'Никита Владимирович Т.',
+        'bank': 'СБП'
+    },
+    'tbank': {
+        'status': 'coming_soon',
+        'message': 'Скоро'
+    }
+}
+
+SALES_DAILY_QUERY = """
+    SELECT created_at::date AS day, payment_method, COUNT(*) AS orders_count,
+           SUM(total_amount) AS total_amount, SUM(discount_amount) AS discount_amount, SUM(final_amount) AS final_amount
+    FROM orders
+    WHERE payment_status = 'paid' AND created_at >= %(start)s AND created_at < %(end)s
+    GROUP BY 1, 2
+"""
+
+SALES_CATEGORY_QUERY = """
+    SELECT o.created_at::date AS day, p.category, SUM(oi.quantity) AS items_sold, SUM(oi.total_price) AS gross_revenue
+    FROM orders o
+    JOIN order_items oi ON oi.order_id = o.id
+    JOIN products p ON p.id = oi.product_id
+    WHERE o.payment_status = 'paid' AND o.created_at >= %(start)s AND o.created_at < %(end)s
+      AND (oi.order_created_at >= %(start)s AND oi.order_created_at < %(end)s OR oi.order_created_at IS NULL)
+    GROUP BY 1, 2
+"""
+
+_replica_lagging_until = 0.0
+_replica_healthy_until = 0.0
+_local_buckets: Dict[str, tuple] = {}
+_idle_connections: Dict[str, List[tuple]] = {}
+_connection_dsn: Dict[int, str] = {}
+_acquire_wait = {'average': 0.0, 'sampled_at': 0.0}
+_async_loop = None
+_async_pool = None
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -17,13 +110,30 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token, X-Min-Lsn',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
             'isBase64Encoded': False
         }
     
+    if method == 'POST':
+        body_data = json.loads(event.get('body', '{}'))
+        admin_action = body_data.get('action')
+        
+        if admin_action == 'confirm_payment':
+            return confirm_payment(body_data)
+        elif admin_action == 'migrate_orders':
+            return migrate_orders(body_data)
+        elif admin_action == 'maintain_order_partitions':
+            return maintain_order_partitions(body_data)
+        elif admin_action == 'sales_report':
+            return sales_report(body_data)
+        elif admin_action == 'refresh_sales_rollup':
+            return refresh_sales_rollup(body_data)
+        elif admin_action == 'export_sales':
+            return export_sales(body_data)
+    
     headers = event.get('headers', {})
     user_token = headers.get('X-Auth-Token') or headers.get('x-auth-token')
     
@@ -45,13 +155,23 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
     
     if method == 'GET':
-        return get_orders(user_id)
+        return get_orders(user_id, event)
     elif method == 'POST':
         body_data = json.loads(event.get('body', '{}'))
         action = body_data.get('action')
         
         if action == 'create':
+            # Ограничение частоты только для оформления заказа: checkout лишь читает данные
+            rejection = admission_control(event, user_id)
+            if rejection:
+                return rejection
+            if ORDERS_ASYNC:
+                return run_async(create_order_async(user_id, body_data))
             return create_order(user_id, body_data)
+        elif action == 'checkout':
+            if ORDERS_ASYNC:
+                return run_async(checkout_async(user_id))
+            return checkout(user_id)
     
     return {
         'statusCode': 405,
@@ -69,62 +189,397 @@ def verify_user_token(token: str) -> int:
     except:
         return None
 
-def get_orders(user_id: int) -> Dict[str, Any]:
-    dsn = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(dsn)
+def acquire_connection(dsn: Optional[str] = None, connect_timeout: float = DB_CONNECT_TIMEOUT) -> Any:
+    '''
+    Соединение из пула экземпляра функции (или новое, если свободных нет)
+    Для сброса нагрузки учитывается только время успешного получения соединения с основной БД
+    '''
+    primary_dsn = os.environ.get('DATABASE_URL')
+    dsn = dsn or primary_dsn
+    started = time.monotonic()
+    idle = _idle_connections.get(dsn, [])
+    conn = None
+    
+    while idle and conn is None:
+        candidate, released_at = idle.pop()
+        if started - released_at > DB_IDLE_CHECK_SECONDS:
+            try:
+                check = candidate.cursor()
+                check.execute("SELECT 1")
+                check.close()
+                candidate.rollback()
+            except psycopg2.Error:
+                _connection_dsn.pop(id(candidate), None)
+                candidate.close()
+                continue
+        conn = candidate
+    
+    if conn is None:
+        conn = psycopg2.connect(dsn, connect_timeout=connect_timeout)
+        _connection_dsn[id(conn)] = dsn
+    
+    if dsn == primary_dsn:
+        _acquire_wait['average'] = _acquire_wait['average'] * 0.8 + (time.monotonic() - started) * 0.2
+        _acquire_wait['sampled_at'] = time.monotonic()
+    
+    return conn
+
+def release_connection(conn: Any) -> None:
+    dsn = _connection_dsn.get(id(conn))
+    
+    if not conn.closed and dsn:
+        try:
+            conn.rollback()
+            idle = _idle_connections.setdefault(dsn, [])
+            if len(idle) < DB_POOL_SIZE:
+                idle.append((conn, time.monotonic()))
+                return
+        except psycopg2.Error:
+            pass
+    
+    _connection_dsn.pop(id(conn), None)
+    conn.close()
+
+def is_overloaded() -> bool:
+    recent = time.monotonic() - _acquire_wait['sampled_at'] < DB_SHED_WINDOW_SECONDS
+    return recent and _acquire_wait['average'] > DB_ACQUIRE_BUDGET_SECONDS
+
+def get_client_ip(event: Dict[str, Any]) -> Optional[str]:
+    identity = (event.get('requestContext') or {}).get('identity') or {}
+    if identity.get('sourceIp'):
+        return identity['sourceIp']
+    
+    headers = event.get('headers', {})
+    forwarded = headers.get('X-Forwarded-For') or headers.get('x-forwarded-for')
+    return forwarded.split(',')[0].strip() if forwarded else None
+
+def take_local_token(key: str, rate: float, burst: float) -> float:
+    now = time.monotonic()
+    if len(_local_buckets) > LOCAL_BUCKETS_MAX:
+        _local_buckets.clear()
+    
+    tokens, updated_at = _local_buckets.get(key, (burst, now))
+    tokens = min(burst, tokens + (now - updated_at) * rate)
+    
+    if tokens >= 1:
+        _local_buckets[key] = (tokens - 1, now)
+        return 0.0
+    
+    _local_buckets[key] = (tokens, now)
+    return (1 - tokens) / rate
+
+def take_shared_tokens(limits: List[tuple]) -> float:
+    conn = acquire_connection()
     cursor = conn.cursor()
     
     try:
-        cursor.execute("""
+        cursor.execute(
+            "SELECT GREATEST(" + ", ".join(["take_rate_limit_token(%s, %s, %s)"] * len(limits)) + ")",
+            [value for limit in limits for value in limit]
+        )
+        retry_after = cursor.fetchone()[0]
+        conn.commit()
+        return retry_after
+    finally:
+        cursor.close()
+        release_connection(conn)
+
+def admission_control(event: Dict[str, Any], user_id: int) -> Optional[Dict[str, Any]]:
+    '''
+    Ограничение частоты запросов по пользователю и IP (token bucket) и сброс нагрузки
+    Сначала проверяется корзина в памяти экземпляра, затем общая корзина в БД
+    '''
+    if is_overloaded():
+        return {
+            'statusCode': 503,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*',
+                'Retry-After': str(DB_SHED_RETRY_AFTER)
+            },
+            'body': json.dumps({'error': 'Service overloaded, try again later'}),
+            'isBase64Encoded': False
+        }
+    
+    limits = [(f'{RATE_LIMIT_SCOPE}:user:{user_id}',) + RATE_LIMIT_USER]
+    client_ip = get_client_ip(event)
+    if client_ip:
+        limits.append((f'{RATE_LIMIT_SCOPE}:ip:{client_ip}',) + RATE_LIMIT_IP)
+    
+    retry_after = max(take_local_token(*limit) for limit in limits)
+    
+    if not retry_after:
+        try:
+            retry_after = take_shared_tokens(limits)
+        except psycopg2.Error:
+            retry_after = 0
+    
+    if retry_after:
+        return {
+            'statusCode': 429,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*',
+                'Retry-After': str(math.ceil(retry_after))
+            },
+            'body': json.dumps({'error': 'Too many requests'}),
+            'isBase64Encoded': False
+        }
+    
+    return None
+
+def connect_for_read(min_lsn: Optional[str] = None) -> Any:
+    '''
+    Подключение для чтения: реплика DATABASE_REPLICA_URL, если она не отстает,
+    иначе основная БД. min_lsn - позиция WAL последней записи клиента (X-Min-Lsn)
+    Результат проверки отставания кэшируется на REPLICA_LAG_CHECK_INTERVAL; без min_lsn
+    в это время реплика отдается без лишнего запроса
+    '''
+    global _replica_lagging_until, _replica_healthy_until
+    
+    replica_dsn = os.environ.get('DATABASE_REPLICA_URL')
+    if min_lsn and not re.fullmatch(r'[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}', min_lsn):
+        min_lsn = None
+    
+    if replica_dsn and time.monotonic() >= _replica_lagging_until:
+        try:
+            conn = acquire_connection(replica_dsn, REPLICA_CONNECT_TIMEOUT)
+        except psycopg2.Error:
+            conn = None
+            _replica_lagging_until = time.monotonic() + REPLICA_LAG_CHECK_INTERVAL
+        
+        if conn:
+            if not min_lsn and time.monotonic() < _replica_healthy_until:
+                return conn
+            
+            # Без работающего WAL receiver равенство receive/replay ничего не говорит об отставании:
+            # такая реплика считается отстающей (NULL). Зависший приемник завершается
+            # по wal_receiver_timeout и тоже попадает в эту ветку
+            try:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT CASE WHEN NOT EXISTS (
+                                    SELECT 1 FROM pg_stat_wal_receiver WHERE COALESCE(status, 'streaming') = 'streaming'
+                                ) THEN NULL
+                                WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                                ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END,
+                           %s::pg_lsn IS NULL OR pg_last_wal_replay_lsn() >= %s::pg_lsn
+                """, (min_lsn, min_lsn))
+                lag, caught_up = cursor.fetchone()
+                cursor.close()
+            except psycopg2.Error:
+                lag, caught_up = None, False
+            
+            lagging = lag is None or lag > REPLICA_MAX_LAG_SECONDS
+            if not lagging:
+                _replica_healthy_until = time.monotonic() + REPLICA_LAG_CHECK_INTERVAL
+                if caught_up:
+                    return conn
+            
+            release_connection(conn)
+            if lagging:
+                _replica_healthy_until = 0.0
+                _replica_lagging_until = time.monotonic() + REPLICA_LAG_CHECK_INTERVAL
+    
+    return acquire_connection()
+
+def get_orders(user_id: int, event: Dict[str, Any]) -> Dict[str, Any]:
+    params = event.get('queryStringParameters') or {}
+    headers = event.get('headers', {})
+    fields = parse_fields(params, ORDER_FIELDS)
+    
+    try:
+        limit = min(int(params.get('limit') or ORDERS_PAGE_SIZE), ORDERS_PAGE_SIZE_MAX)
+        if limit < 1:
+            raise ValueError('limit must be positive')
+        before_key = None
+        if params.get('before') and params.get('before_id'):
+            before_key = (datetime.fromisoformat(params['before']), int(params['before_id']))
+    except ValueError:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Invalid paging parameters'}),
+            'isBase64Encoded': False
+        }
+    
+    conn = connect_for_read(headers.get('X-Min-Lsn') or headers.get('x-min-lsn'))
+    cursor = conn.cursor()
+    
+    try:
+        query = """
             SELECT id, total_amount, discount_amount, final_amount, payment_method, payment_status, status, created_at
             FROM orders
             WHERE user_id = %s
-            ORDER BY created_at DESC
-        """, (user_id,))
+        """
+        query_params = [user_id]
+        
+        if before_key:
+            query += " AND (created_at, id) < (%s, %s)"
+            query_params.extend(before_key)
         
+        query += " ORDER BY created_at DESC, id DESC LIMIT %s"
+        query_params.append(limit)
+        
+        cursor.execute(query, query_params)
         orders = cursor.fetchall()
-        result = []
         
-        for order in orders:
-            order_id = order[0]
-            
+        items_by_order = {}
+        if orders:
             cursor.execute("""
-                SELECT product_name, product_price, quantity, total_price
+                SELECT order_id, product_name, product_price, quantity, total_price
                 FROM order_items
-                WHERE order_id = %s
-            """, (order_id,))
+                WHERE order_id = ANY(%s)
+                  AND (order_created_at BETWEEN %s AND %s OR order_created_at IS NULL)
+                ORDER BY id
+            """, ([order[0] for order in orders], orders[-1][7], orders[0][7]))
             
-            items = cursor.fetchall()
-            order_items = []
-            for item in items:
-                order_items.append({
-                    'product_name': item[0],
-                    'product_price': float(item[1]),
-                    'quantity': item[2],
-                    'total_price': float(item[3])
+            for item in cursor.fetchall():
+                items_by_order.setdefault(item[0], []).append({
+                    'product_name': item[1],
+                    'product_price': float(item[2]),
+                    'quantity': item[3],
+                    'total_price': float(item[4])
                 })
-            
-            result.append({
-                'id': order_id,
-                'total_amount': float(order[1]),
-                'discount_amount': float(order[2]),
-                'final_amount': float(order[3]),
-                'payment_method': order[4],
-                'payment_status': order[5],
-                'status': order[6],
-                'created_at': order[7].isoformat() if order[7] else None,
-                'items': order_items
-            })
         
+        result = [serialize_order(order, items_by_order.get(order[0], [])) for order in orders]
+        
+        if len(result) < limit:
+            result.extend(load_archived_orders(cursor, user_id, before_key, limit - len(result)))
+        
+        next_cursor = None
+        if len(result) == limit:
+            next_cursor = {'before': result[-1]['created_at'], 'before_id': result[-1]['id']}
+        
+        return build_response(event, serialize_body({'orders': project(result, fields), 'next_cursor': next_cursor}))
+    finally:
+        cursor.close()
+        release_connection(conn)
+
+def parse_fields(params: Dict[str, Any], allowed: tuple) -> Optional[tuple]:
+    requested = [field.strip() for field in (params.get('fields') or '').split(',')]
+    fields = tuple(field for field in requested if field in allowed)
+    return fields or None
+
+def project(rows: List[Dict[str, Any]], fields: Optional[tuple]) -> List[Dict[str, Any]]:
+    if not fields:
+        return rows
+    return [{field: row[field] for field in fields} for row in rows]
+
+def serialize_body(payload: Dict[str, Any]) -> bytes:
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def negotiate_encoding(event: Dict[str, Any]) -> Optional[str]:
+    headers = event.get('headers') or {}
+    accept = headers.get('Accept-Encoding') or headers.get('accept-encoding') or ''
+    
+    accepted = {}
+    for part in accept.split(','):
+        name, _, params = part.partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    
+    for encoding in ('br', 'gzip'):
+        if encoding == 'br' and brotli is None:
+            continue
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+def compress_body(raw: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(raw, quality=BROTLI_QUALITY)
+    return gzip.compress(raw, compresslevel=GZIP_LEVEL, mtime=0)
+
+def build_response(event: Dict[str, Any], body: bytes, variants: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    '''
+    Ответ 200 с JSON-телом, сжатым по Accept-Encoding (br/gzip), если тело больше порога
+    variants - кэш уже сжатых вариантов тела, дополняется при промахе
+    '''
+    headers = {
+        'Content-Type': 'application/json; charset=utf-8',
+        'Access-Control-Allow-Origin': '*',
+        'Vary': 'Accept-Encoding'
+    }
+    encoding = negotiate_encoding(event) if len(body) >= COMPRESSION_MIN_BYTES else None
+    
+    if not encoding:
         return {
             'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'orders': result}),
+            'headers': headers,
+            'body': body.decode('utf-8'),
             'isBase64Encoded': False
         }
-    finally:
-        cursor.close()
-        conn.close()
+    
+    if variants is not None and encoding in variants:
+        encoded = variants[encoding]
+    else:
+        encoded = base64.b64encode(compress_body(body, encoding)).decode('ascii')
+        if variants is not None:
+            variants[encoding] = encoded
+    
+    headers['Content-Encoding'] = encoding
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': encoded,
+        'isBase64Encoded': True
+    }
+
+def serialize_order(order: tuple, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        'id': order[0],
+        'total_amount': float(order[1]),
+        'discount_amount': float(order[2]),
+        'final_amount': float(order[3]),
+        'payment_method': order[4],
+        'payment_status': order[5],
+        'status': order[6],
+        'created_at': order[7].isoformat() if order[7] else None,
+        'items': items
+    }
+
+def load_archived_orders(cursor: Any, user_id: int, before_key: Optional[tuple], limit: int) -> List[Dict[str, Any]]:
+    '''
+    Чтение заказов из архива (orders_archive), когда живые секции исчерпаны
+    Архив хранится по месяцам: месяцы читаются и распаковываются по одному,
+    пока не наберется limit заказов
+    '''
+    month_bound = None
+    if before_key:
+        month_bound = (date(before_key[0].year, before_key[0].month, 1) + timedelta(days=32)).replace(day=1)
+    
+    result = []
+    while len(result) < limit:
+        if month_bound:
+            cursor.execute(
+                "SELECT month, payload FROM orders_archive WHERE user_id = %s AND month < %s ORDER BY month DESC LIMIT 1",
+                (user_id, month_bound)
+            )
+        else:
+            cursor.execute(
+                "SELECT month, payload FROM orders_archive WHERE user_id = %s ORDER BY month DESC LIMIT 1",
+                (user_id,)
+            )
+        row = cursor.fetchone()
+        if not row:
+            break
+        
+        month_bound, payload = row
+        for order in json.loads(gzip.decompress(bytes(payload))):
+            if before_key and (datetime.fromisoformat(order['created_at']), order['id']) >= before_key:
+                continue
+            result.append(order)
+            if len(result) == limit:
+                break
+    
+    return result
 
 def create_order(user_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
     payment_method = data.get('payment_method')
@@ -138,8 +593,7 @@ def create_order(user_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
-    dsn = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(dsn)
+    conn = acquire_connection()
     cursor = conn.cursor()
     
     try:
@@ -168,7 +622,7 @@ def create_order(user_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
             discount_used = cursor.fetchone()[0]
             
             if not discount_used:
-                discount_amount = total_amount * 0.20
+                discount_amount = total_amount * FIRST_ORDER_DISCOUNT_RATE
                 cursor.execute("UPDATE users SET first_order_discount_used = TRUE WHERE id = %s", (user_id,))
         
         final_amount = total_amount - discount_amount
@@ -176,45 +630,36 @@ def create_order(user_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
         cursor.execute("""
             INSERT INTO orders (user_id, total_amount, discount_amount, final_amount, payment_method, payment_status, status)
             VALUES (%s, %s, %s, %s, %s, 'pending', 'pending')
-            RETURNING id
+            RETURNING id, created_at
         """, (user_id, total_amount, discount_amount, final_amount, payment_method))
         
-        order_id = cursor.fetchone()[0]
+        order_id, order_created_at = cursor.fetchone()
         
         for item in cart_items:
             product_id, quantity, name, price = item
             item_total = float(price) * quantity
             cursor.execute("""
-                INSERT INTO order_items (order_id, product_id, product_name, product_price, quantity, total_price)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """, (order_id, product_id, name, price, quantity, item_total))
+                INSERT INTO order_items (order_id, product_id, product_name, product_price, quantity, total_price, order_created_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """, (order_id, product_id, name, price, quantity, item_total, order_created_at))
         
         cursor.execute("DELETE FROM cart WHERE user_id = %s", (user_id,))
         
         conn.commit()
         
-        payment_info = {}
-        if payment_method == 'sberbank':
-            payment_info = {
-                'card_number': '2202 2083 9585 3485',
-                'recipient': 'Никита Владимирович Т.',
-                'bank': 'Сбербанк'
-            }
-        elif payment_method == 'sbp':
-            payment_info = {
-                'phone': '+7 (XXX) XXX-XX-XX',
-                'recipient': 'Никита Владимирович Т.',
-                'bank': 'СБП'
-            }
-        elif payment_method == 'tbank':
-            payment_info = {
-                'status': 'coming_soon',
-                'message': 'Скоро'
-            }
+        cursor.execute("SELECT pg_current_wal_lsn()")
+        write_lsn = cursor.fetchone()[0]
+        
+        payment_info = PAYMENT_INFO.get(payment_method, {})
         
         return {
             'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Expose-Headers': 'X-Write-Lsn',
+                'X-Write-Lsn': write_lsn
+            },
             'body': json.dumps({
                 'success': True,
                 'order_id': order_id,
@@ -226,4 +671,780 @@ def create_order(user_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
         }
     finally:
         cursor.close()
-        conn.close()
+        release_connection(conn)
+
+def checkout(user_id: int) -> Dict[str, Any]:
+    conn = acquire_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("""
+            SELECT c.id, c.product_id, c.quantity, p.name, p.price
+            FROM cart c
+            JOIN products p ON c.product_id = p.id
+            WHERE c.user_id = %s
+        """, (user_id,))
+        cart_rows = cursor.fetchall()
+        
+        cursor.execute("SELECT name, email, avatar_url, first_order_discount_used FROM users WHERE id = %s", (user_id,))
+        user = cursor.fetchone()
+        
+        return checkout_response(cart_rows, user)
+    finally:
+        cursor.close()
+        release_connection(conn)
+
+def checkout_response(cart_rows: List[Any], user: Any) -> Dict[str, Any]:
+    if not user:
+        return {
+            'statusCode': 404,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'User not found'}),
+            'isBase64Encoded': False
+        }
+    
+    items = []
+    total = 0
+    for row in cart_rows:
+        item_total = float(row[4]) * row[2]
+        total += item_total
+        items.append({
+            'id': row[0],
+            'product_id': row[1],
+            'quantity': row[2],
+            'name': row[3],
+            'price': float(row[4]),
+            'total': item_total
+        })
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({
+            'cart': {'items': items, 'total': total, 'count': len(items)},
+            'user': {'name': user[0], 'email': user[1], 'avatar_url': user[2]},
+            'discount_available': not user[3],
+            'payment_methods': [
+                {'id': method, 'available': info.get('status') != 'coming_soon'}
+                for method, info in PAYMENT_INFO.items()
+            ]
+        }),
+        'isBase64Encoded': False
+    }
+
+def run_async(coroutine: Any) -> Any:
+    '''
+    Выполнение асинхронного обработчика в постоянном цикле событий экземпляра,
+    чтобы пул asyncpg переживал вызовы функции
+    '''
+    global _async_loop
+    if _async_loop is None or _async_loop.is_closed():
+        _async_loop = asyncio.new_event_loop()
+    return _async_loop.run_until_complete(coroutine)
+
+async def get_async_pool() -> Any:
+    global _async_pool
+    if _async_pool is None:
+        import asyncpg
+        _async_pool = await asyncpg.create_pool(
+            os.environ.get('DATABASE_URL'),
+            min_size=ASYNC_POOL_MIN_SIZE,
+            max_size=ASYNC_POOL_MAX_SIZE,
+            timeout=DB_CONNECT_TIMEOUT
+        )
+    return _async_pool
+
+async def checkout_async(user_id: int) -> Dict[str, Any]:
+    pool = await get_async_pool()
+    
+    cart_rows, user = await asyncio.gather(
+        pool.fetch("""
+            SELECT c.id, c.product_id, c.quantity, p.name, p.price
+            FROM cart c
+            JOIN products p ON c.product_id = p.id
+            WHERE c.user_id = $1
+        """, user_id),
+        pool.fetchrow("SELECT name, email, avatar_url, first_order_discount_used FROM users WHERE id = $1", user_id)
+    )
+    
+    return checkout_response(cart_rows, user)
+
+async def create_order_async(user_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Асинхронное оформление заказа: корзина и признак скидки читаются параллельно,
+    позиции заказа вставляются одним конвейером executemany
+    '''
+    payment_method = data.get('payment_method')
+    use_discount = data.get('use_discount', False)
+    
+    if not payment_method:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'payment_method required'}),
+            'isBase64Encoded': False
+        }
+    
+    pool = await get_async_pool()
+    
+    async def fetch_discount_used() -> bool:
+        if not use_discount:
+            return True
+        return await pool.fetchval("SELECT first_order_discount_used FROM users WHERE id = $1", user_id)
+    
+    cart_items, discount_used = await asyncio.gather(
+        pool.fetch("""
+            SELECT c.id, c.product_id, c.quantity, p.name, p.price
+            FROM cart c
+            JOIN products p ON c.product_id = p.id
+            WHERE c.user_id = $1
+        """, user_id),
+        fetch_discount_used()
+    )
+    
+    if not cart_items:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Cart is empty'}),
+            'isBase64Encoded': False
+        }
+    
+    total_amount = sum(item['price'] * item['quantity'] for item in cart_items)
+    discount_amount = Decimal(0)
+    
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            if not discount_used:
+                claimed = await conn.fetchval(
+                    "UPDATE users SET first_order_discount_used = TRUE WHERE id = $1 AND first_order_discount_used IS NOT TRUE RETURNING id",
+                    user_id
+                )
+                if claimed:
+                    discount_amount = (total_amount * Decimal(str(FIRST_ORDER_DISCOUNT_RATE))).quantize(Decimal('0.01'))
+            
+            final_amount = total_amount - discount_amount
+            
+            order = await conn.fetchrow("""
+                INSERT INTO orders (user_id, total_amount, discount_amount, final_amount, payment_method, payment_status, status)
+                VALUES ($1, $2, $3, $4, $5, 'pending', 'pending')
+                RETURNING id, created_at
+            """, user_id, total_amount, discount_amount, final_amount, payment_method)
+            
+            await conn.executemany("""
+                INSERT INTO order_items (order_id, product_id, product_name, product_price, quantity, total_price, order_created_at)
+                VALUES ($1, $2, $3, $4, $5, $6, $7)
+            """, [
+                (order['id'], item['product_id'], item['name'], item['price'], item['quantity'],
+                 item['price'] * item['quantity'], order['created_at'])
+                for item in cart_items
+            ])
+            
+            await conn.execute(
+                "DELETE FROM cart WHERE user_id = $1 AND id = ANY($2::int[])",
+                user_id, [item['id'] for item in cart_items]
+            )
+        
+        write_lsn = await conn.fetchval("SELECT pg_current_wal_lsn()::text")
+    
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Expose-Headers': 'X-Write-Lsn',
+            'X-Write-Lsn': write_lsn
+        },
+        'body': json.dumps({
+            'success': True,
+            'order_id': order['id'],
+            'final_amount': float(final_amount),
+            'payment_info': PAYMENT_INFO.get(payment_method, {}),
+            'message': 'Order created successfully'
+        }),
+        'isBase64Encoded': False
+    }
+
+def is_admin(data: Dict[str, Any]) -> bool:
+    admin_secret = os.environ.get('ADMIN_SECRET')
+    return bool(admin_secret) and data.get('admin_key') == admin_secret
+
+def confirm_payment(data: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Подтверждение оплаты заказа администратором
+    Начисляет реферальное вознаграждение пригласившему пользователю
+    '''
+    if not is_admin(data):
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Forbidden'}),
+            'isBase64Encoded': False
+        }
+    
+    order_id = data.get('order_id')
+    if not order_id:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'order_id required'}),
+            'isBase64Encoded': False
+        }
+    
+    conn = acquire_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("""
+            UPDATE orders
+            SET payment_status = 'paid', updated_at = CURRENT_TIMESTAMP
+            WHERE id = %s AND payment_status <> 'paid'
+            RETURNING user_id, final_amount
+        """, (order_id,))
+        order = cursor.fetchone()
+        
+        if not order:
+            conn.rollback()
+            return {
+                'statusCode': 409,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Order not found or already paid'}),
+                'isBase64Encoded': False
+            }
+        
+        buyer_id, final_amount = order
+        reward = 0
+        
+        cursor.execute("SELECT referrer_id FROM referrals WHERE referred_id = %s", (buyer_id,))
+        referral = cursor.fetchone()
+        
+        if referral:
+            referrer_id = referral[0]
+            reward = round(float(final_amount) * REFERRAL_REWARD_RATE, 2)
+            cursor.execute("""
+                INSERT INTO referral_earnings_ledger (referrer_id, referred_id, order_id, amount)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (order_id) DO NOTHING
+                RETURNING id
+            """, (referrer_id, buyer_id, order_id, reward))
+            
+            if cursor.fetchone():
+                cursor.execute(
+                    "UPDATE users SET referral_earnings = COALESCE(referral_earnings, 0) + %s WHERE id = %s",
+                    (reward, referrer_id)
+                )
+            else:
+                reward = 0
+        
+        conn.commit()
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': True, 'order_id': order_id, 'referral_reward': reward}),
+            'isBase64Encoded': False
+        }
+    finally:
+        cursor.close()
+        release_connection(conn)
+
+def migrate_orders(data: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Фоновый перенос заказов в секционированные таблицы порциями
+    Вызывается повторно, пока не вернет completed; последний вызов подменяет таблицы
+    '''
+    if not is_admin(data):
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Forbidden'}),
+            'isBase64Encoded': False
+        }
+    
+    batch_size = int(data.get('batch_size') or ORDERS_MIGRATION_BATCH_SIZE)
+    
+    conn = acquire_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("SELECT last_order_id, completed_at FROM orders_partition_migration WHERE id = 1 FOR UPDATE")
+        last_order_id, completed_at = cursor.fetchone()
+        
+        if completed_at:
+            conn.rollback()
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'completed': True, 'copied': 0}),
+                'isBase64Encoded': False
+            }
+        
+        cursor.execute("""
+            WITH batch AS (
+                SELECT id, user_id, total_amount, discount_amount, final_amount, payment_method, payment_status, status, created_at, updated_at
+                FROM orders
+                WHERE id > %s
+                ORDER BY id
+                LIMIT %s
+            ), copied AS (
+                INSERT INTO orders_partitioned (id, user_id, total_amount, discount_amount, final_amount, payment_method, payment_status, status, created_at, updated_at)
+                SELECT * FROM batch
+                ON CONFLICT (id, created_at) DO NOTHING
+            )
+            SELECT COUNT(*), MAX(id) FROM batch
+        """, (last_order_id, batch_size))
+        copied, max_order_id = cursor.fetchone()
+        
+        if copied:
+            cursor.execute("""
+                INSERT INTO order_items_partitioned (id, order_id, product_id, product_name, product_price, quantity, total_price, order_created_at)
+                SELECT oi.id, oi.order_id, oi.product_id, oi.product_name, oi.product_price, oi.quantity, oi.total_price,
+                       COALESCE(oi.order_created_at, o.created_at)
+                FROM order_items oi
+                JOIN orders o ON o.id = oi.order_id
+                WHERE oi.order_id > %s AND oi.order_id <= %s
+                ON CONFLICT (id, order_created_at) DO NOTHING
+            """, (last_order_id, max_order_id))
+            cursor.execute("UPDATE orders_partition_migration SET last_order_id = %s WHERE id = 1", (max_order_id,))
+            conn.commit()
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'completed': False, 'copied': copied, 'last_order_id': max_order_id}),
+                'isBase64Encoded': False
+            }
+        
+        # Все старые строки перенесены, новые дублируются триггерами: подменяем таблицы
+        cursor.execute("LOCK TABLE orders, order_items IN EXCLUSIVE MODE")
+        cursor.execute("DROP TRIGGER IF EXISTS trg_order_items_mirror ON order_items")
+        cursor.execute("DROP TRIGGER IF EXISTS trg_orders_mirror ON orders")
+        cursor.execute("ALTER TABLE order_items RENAME TO order_items_legacy")
+        cursor.execute("ALTER TABLE orders RENAME TO orders_legacy")
+        cursor.execute("ALTER TABLE orders_partitioned RENAME TO orders")
+        cursor.execute("ALTER TABLE order_items_partitioned RENAME TO order_items")
+        cursor.execute("UPDATE orders_partition_migration SET completed_at = CURRENT_TIMESTAMP WHERE id = 1")
+        conn.commit()
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'completed': True, 'copied': 0}),
+            'isBase64Encoded': False
+        }
+    finally:
+        cursor.close()
+        release_connection(conn)
+
+def maintain_order_partitions(data: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Периодическое обслуживание секций заказов
+    Создает секции на ближайшие месяцы и переносит старые секции в orders_archive
+    '''
+    if not is_admin(data):
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Forbidden'}),
+            'isBase64Encoded': False
+        }
+    
+    archive_after_months = int(data.get('archive_after_months') or ORDERS_ARCHIVE_AFTER_MONTHS)
+    
+    conn = acquire_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("SELECT completed_at FROM orders_partition_migration WHERE id = 1")
+        if not cursor.fetchone()[0]:
+            return {
+                'statusCode': 409,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Orders migration is not completed'}),
+                'isBase64Encoded': False
+            }
+        
+        cursor.execute("""
+            SELECT create_order_partitions((date_trunc('month', CURRENT_DATE) + make_interval(months => n))::date)
+            FROM generate_series(0, 2) AS n
+        """)
+        conn.commit()
+        
+        cursor.execute("""
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'orders'::regclass
+              AND c.relname ~ '^orders_y[0-9]{4}m[0-9]{2}$'
+            ORDER BY c.relname
+        """)
+        partitions = [row[0] for row in cursor.fetchall()]
+        
+        today = date.today()
+        cutoff_index = today.year * 12 + today.month - 1 - archive_after_months
+        archived = []
+        
+        for partition in partitions:
+            month = date(int(partition[8:12]), int(partition[13:15]), 1)
+            if month.year * 12 + month.month - 1 >= cutoff_index:
+                continue
+            archive_order_partition(conn, partition[len('orders_'):], month)
+            archived.append(month.isoformat())
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': True, 'archived_months': archived}),
+            'isBase64Encoded': False
+        }
+    finally:
+        cursor.close()
+        release_connection(conn)
+
+def archive_order_partition(conn: Any, suffix: str, month: date) -> None:
+    orders_partition = sql.Identifier('orders_' + suffix)
+    items_partition = sql.Identifier('order_items_' + suffix)
+    
+    reader = conn.cursor(name=f'archive_{suffix}')
+    reader.itersize = 1000
+    writer = conn.cursor()
+    
+    try:
+        reader.execute(sql.SQL("""
+            SELECT o.user_id, o.id, o.total_amount, o.discount_amount, o.final_amount, o.payment_method,
+                   o.payment_status, o.status, o.created_at,
+                   COALESCE(json_agg(json_build_object(
+                       'product_name', i.product_name,
+                       'product_price', i.product_price,
+                       'quantity', i.quantity,
+                       'total_price', i.total_price
+                   ) ORDER BY i.id) FILTER (WHERE i.id IS NOT NULL), '[]')
+            FROM {orders} o
+            LEFT JOIN {items} i ON i.order_id = o.id
+            GROUP BY o.id, o.created_at
+            ORDER BY o.user_id, o.created_at DESC, o.id DESC
+        """).format(orders=orders_partition, items=items_partition))
+        
+        def flush(user_id: int, user_orders: List[Dict[str, Any]]) -> None:
+            writer.execute("""
+                INSERT INTO orders_archive (user_id, month, order_count, payload)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (user_id, month) DO UPDATE SET
+                    order_count = EXCLUDED.order_count,
+                    payload = EXCLUDED.payload,
+                    archived_at = CURRENT_TIMESTAMP
+            """, (user_id, month, len(user_orders), psycopg2.Binary(gzip.compress(json.dumps(user_orders).encode('utf-8')))))
+        
+        current_user_id = None
+        user_orders = []
+        
+        for row in reader:
+            if row[0] != current_user_id and user_orders:
+                flush(current_user_id, user_orders)
+                user_orders = []
+            current_user_id = row[0]
+            items = [
+                {
+                    'product_name': item['product_name'],
+                    'product_price': float(item['product_price']),
+                    'quantity': item['quantity'],
+                    'total_price': float(item['total_price'])
+                }
+                for item in row[9]
+            ]
+            user_orders.append(serialize_order(row[1:9], items))
+        
+        if user_orders:
+            flush(current_user_id, user_orders)
+        
+        reader.close()
+        
+        # Позиции удаляются до отсоединения секции заказов: внешний ключ отсоединенной
+        # секции order_items продолжает ссылаться на orders и не дал бы ее отсоединить
+        writer.execute(sql.SQL("ALTER TABLE order_items DETACH PARTITION {}").format(items_partition))
+        writer.execute(sql.SQL("DROP TABLE {}").format(items_partition))
+        writer.execute(sql.SQL("ALTER TABLE orders DETACH PARTITION {}").format(orders_partition))
+        writer.execute(sql.SQL("DROP TABLE {}").format(orders_partition))
+        conn.commit()
+    finally:
+        writer.close()
+
+def get_db_today(cursor: Any) -> date:
+    # Граница "сегодня" берется из БД: created_at пишется через CURRENT_TIMESTAMP в ее часовом поясе
+    cursor.execute("SELECT CURRENT_DATE")
+    return cursor.fetchone()[0]
+
+def parse_report_range(data: Dict[str, Any], today: date) -> tuple:
+    date_to = date.fromisoformat(data['date_to']) if data.get('date_to') else today
+    if data.get('date_from'):
+        date_from = date.fromisoformat(data['date_from'])
+    else:
+        date_from = date_to - timedelta(days=SALES_REPORT_DEFAULT_DAYS - 1)
+    return date_from, date_to
+
+def sales_report(data: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Отчет о продажах по дням, категориям или способам оплаты
+    Прошедшие дни читаются из дневных агрегатов, текущий день считается на лету
+    '''
+    if not is_admin(data):
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Forbidden'}),
+            'isBase64Encoded': False
+        }
+    
+    group_by = data.get('group_by', 'day')
+    
+    conn = connect_for_read()
+    cursor = conn.cursor()
+    
+    try:
+        today = get_db_today(cursor)
+        
+        try:
+            date_from, date_to = parse_report_range(data, today)
+        except ValueError:
+            date_from = None
+        
+        if group_by not in ('day', 'payment_method', 'category') or not date_from or date_from > date_to:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Invalid group_by or date range'}),
+                'isBase64Encoded': False
+            }
+        
+        # Агрегаты покрывают дни до start, живой подсчет - с start, граница одна для обеих частей
+        range_params = {
+            'date_from': date_from,
+            'date_to': date_to,
+            'start': max(today, date_from),
+            'end': date_to + timedelta(days=1)
+        }
+        
+        if group_by == 'category':
+            cursor.execute(sql.SQL("""
+                WITH daily AS (
+                    SELECT day, category, items_sold, gross_revenue
+                    FROM sales_daily_category
+                    WHERE day >= %(date_from)s AND day <= %(date_to)s AND day < %(start)s
+                    UNION ALL
+                    {live}
+                )
+                SELECT category, SUM(items_sold), SUM(gross_revenue)
+                FROM daily
+                GROUP BY category
+                ORDER BY SUM(gross_revenue) DESC
+            """).format(live=sql.SQL(SALES_CATEGORY_QUERY)), range_params)
+            
+            rows = [
+                {'category': row[0], 'items_sold': int(row[1]), 'gross_revenue': float(row[2])}
+                for row in cursor.fetchall()
+            ]
+        else:
+            cursor.execute(sql.SQL("""
+                WITH daily AS (
+                    SELECT day, payment_method, orders_count, total_amount, discount_amount, final_amount
+                    FROM sales_daily
+                    WHERE day >= %(date_from)s AND day <= %(date_to)s AND day < %(start)s
+                    UNION ALL
+                    {live}
+                )
+                SELECT {key}, SUM(orders_count), SUM(total_amount), SUM(discount_amount), SUM(final_amount)
+                FROM daily
+                GROUP BY 1
+                ORDER BY 1
+            """).format(live=sql.SQL(SALES_DAILY_QUERY), key=sql.Identifier(group_by)), range_params)
+            
+            rows = [
+                {
+                    group_by: row[0].isoformat() if group_by == 'day' else row[0],
+                    'orders_count': int(row[1]),
+                    'total_amount': float(row[2]),
+                    'discount_amount': float(row[3]),
+                    'final_amount': float(row[4])
+                }
+                for row in cursor.fetchall()
+            ]
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({
+                'group_by': group_by,
+                'date_from': date_from.isoformat(),
+                'date_to': date_to.isoformat(),
+                'rows': rows
+            }),
+            'isBase64Encoded': False
+        }
+    finally:
+        cursor.close()
+        release_connection(conn)
+
+def refresh_sales_rollup(data: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Пересчет дневных агрегатов продаж за последние дни
+    Запускается периодически, учитывает поздно подтвержденные оплаты
+    '''
+    if not is_admin(data):
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Forbidden'}),
+            'isBase64Encoded': False
+        }
+    
+    days = int(data.get('days') or SALES_ROLLUP_REFRESH_DAYS)
+    
+    conn = acquire_connection()
+    cursor = conn.cursor()
+    
+    try:
+        today = get_db_today(cursor)
+        range_params = {
+            'start': today - timedelta(days=days),
+            'end': today + timedelta(days=1)
+        }
+        
+        cursor.execute("DELETE FROM sales_daily WHERE day >= %(start)s AND day < %(end)s", range_params)
+        cursor.execute(sql.SQL("""
+            INSERT INTO sales_daily (day, payment_method, orders_count, total_amount, discount_amount, final_amount)
+            {}
+        """).format(sql.SQL(SALES_DAILY_QUERY)), range_params)
+        
+        cursor.execute("DELETE FROM sales_daily_category WHERE day >= %(start)s AND day < %(end)s", range_params)
+        cursor.execute(sql.SQL("""
+            INSERT INTO sales_daily_category (day, category, items_sold, gross_revenue)
+            {}
+        """).format(sql.SQL(SALES_CATEGORY_QUERY)), range_params)
+        
+        conn.commit()
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': True, 'from': range_params['start'].isoformat()}),
+            'isBase64Encoded': False
+        }
+    finally:
+        cursor.close()
+        release_connection(conn)
+
+def export_sales(data: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Выгрузка позиций заказов в CSV (gzip)
+    Строки читаются серверным курсором порциями и сжимаются во временный файл.
+    Вызов останавливается, когда сжатый файл достигает SALES_EXPORT_MAX_BYTES
+    (проверка каждые SALES_EXPORT_FLUSH_ROWS строк), и возвращает X-Next-After-Id.
+    Ответ целиком в памяти: пиковое потребление около 2.5 * SALES_EXPORT_MAX_BYTES
+    независимо от размера выгрузки, тело в base64 не больше ~3 МБ
+    '''
+    if not is_admin(data):
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Forbidden'}),
+            'isBase64Encoded': False
+        }
+    
+    try:
+        after_id = int(data.get('after_id') or 0)
+        max_rows = min(int(data.get('max_rows') or SALES_EXPORT_MAX_ROWS), SALES_EXPORT_MAX_ROWS)
+    except ValueError:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Invalid export parameters'}),
+            'isBase64Encoded': False
+        }
+    
+    conn = connect_for_read()
+    reader = conn.cursor(name='export_sales')
+    reader.itersize = SALES_EXPORT_CHUNK_SIZE
+    
+    try:
+        cursor = conn.cursor()
+        today = get_db_today(cursor)
+        cursor.close()
+        
+        try:
+            date_from, date_to = parse_report_range(data, today)
+        except ValueError:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Invalid export parameters'}),
+                'isBase64Encoded': False
+            }
+        
+        reader.execute("""
+            SELECT oi.id, o.id, o.created_at, o.user_id, o.payment_method, o.payment_status,
+                   p.category, oi.product_id, oi.product_name, oi.product_price, oi.quantity, oi.total_price
+            FROM order_items oi
+            JOIN orders o ON o.id = oi.order_id
+            LEFT JOIN products p ON p.id = oi.product_id
+            WHERE oi.id > %(after_id)s
+              AND o.created_at >= %(start)s AND o.created_at < %(end)s
+              AND (oi.order_created_at >= %(start)s AND oi.order_created_at < %(end)s OR oi.order_created_at IS NULL)
+            ORDER BY oi.id
+            LIMIT %(max_rows)s
+        """, {
+            'after_id': after_id,
+            'start': date_from,
+            'end': date_to + timedelta(days=1),
+            'max_rows': max_rows
+        })
+        
+        rows_written = 0
+        last_id = None
+        truncated = False
+        
+        with tempfile.TemporaryFile() as buffer:
+            with gzip.GzipFile(fileobj=buffer, mode='wb') as compressed:
+                text = io.TextIOWrapper(compressed, encoding='utf-8', newline='')
+                writer = csv.writer(text)
+                writer.writerow([
+                    'item_id', 'order_id', 'created_at', 'user_id', 'payment_method', 'payment_status',
+                    'category', 'product_id', 'product_name', 'product_price', 'quantity', 'total_price'
+                ])
+                
+                for row in reader:
+                    writer.writerow(row[:2] + (row[2].isoformat() if row[2] else '',) + row[3:])
+                    rows_written += 1
+                    last_id = row[0]
+                    
+                    if rows_written % SALES_EXPORT_FLUSH_ROWS == 0:
+                        text.flush()
+                        compressed.flush()
+                        if buffer.tell() >= SALES_EXPORT_MAX_BYTES:
+                            truncated = True
+                            break
+                
+                text.flush()
+                text.detach()
+            
+            buffer.seek(0)
+            body = base64.b64encode(buffer.read()).decode('ascii')
+        
+        next_after_id = last_id if truncated or rows_written == max_rows else None
+        
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Content-Type': 'text/csv; charset=utf-8',
+                'Content-Encoding': 'gzip',
+                'Content-Disposition': f'attachment; filename="sales_{date_from.isoformat()}_{date_to.isoformat()}.csv"',
+                'X-Rows': str(rows_written),
+                'X-Next-After-Id': str(next_after_id) if next_after_id else '',
+                'Access-Control-Expose-Headers': 'X-Rows, X-Next-After-Id',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'body': body,
+            'isBase64Encoded': True
+        }
+    finally:
+        reader.close()
+        release_connection(conn)
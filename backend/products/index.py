@@ -1,7 +1,30 @@
 import json
 import os
+import re
+import gzip
+import time
+import base64
 import psycopg2
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('DATABASE_REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_LAG_CHECK_INTERVAL = 10
+REPLICA_CONNECT_TIMEOUT = 2
+COMPRESSION_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+CATALOG_CACHE_TTL = 60
+CATALOG_CACHE_MAX = 256
+PRODUCT_FIELDS = ('id', 'name', 'category', 'price', 'description', 'image_url', 'is_active')
+
+_replica_lagging_until = 0.0
+_replica_healthy_until = 0.0
+_catalog_cache: Dict[tuple, Dict[str, Any]] = {}
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -39,16 +62,152 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         'isBase64Encoded': False
     }
 
+def connect_for_read(min_lsn: Optional[str] = None) -> Any:
+    '''
+    Подключение для чтения: реплика DATABASE_REPLICA_URL, если она не отстает,
+    иначе основная БД. min_lsn - позиция WAL последней записи клиента (X-Min-Lsn)
+    Результат проверки отставания кэшируется на REPLICA_LAG_CHECK_INTERVAL; без min_lsn
+    в это время реплика отдается без лишнего запроса
+    '''
+    global _replica_lagging_until, _replica_healthy_until
+    
+    replica_dsn = os.environ.get('DATABASE_REPLICA_URL')
+    if min_lsn and not re.fullmatch(r'[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}', min_lsn):
+        min_lsn = None
+    
+    if replica_dsn and time.monotonic() >= _replica_lagging_until:
+        try:
+            conn = psycopg2.connect(replica_dsn, connect_timeout=REPLICA_CONNECT_TIMEOUT)
+        except psycopg2.Error:
+            conn = None
+            _replica_lagging_until = time.monotonic() + REPLICA_LAG_CHECK_INTERVAL
+        
+        if conn:
+            if not min_lsn and time.monotonic() < _replica_healthy_until:
+                return conn
+            
+            # Без работающего WAL receiver равенство receive/replay ничего не говорит об отставании:
+            # такая реплика считается отстающей (NULL). Зависший приемник завершается
+            # по wal_receiver_timeout и тоже попадает в эту ветку
+            try:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT CASE WHEN NOT EXISTS (
+                                    SELECT 1 FROM pg_stat_wal_receiver WHERE COALESCE(status, 'streaming') = 'streaming'
+                                ) THEN NULL
+                                WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                                ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END,
+                           %s::pg_lsn IS NULL OR pg_last_wal_replay_lsn() >= %s::pg_lsn
+                """, (min_lsn, min_lsn))
+                lag, caught_up = cursor.fetchone()
+                cursor.close()
+            except psycopg2.Error:
+                lag, caught_up = None, False
+            
+            lagging = lag is None or lag > REPLICA_MAX_LAG_SECONDS
+            if not lagging:
+                _replica_healthy_until = time.monotonic() + REPLICA_LAG_CHECK_INTERVAL
+                if caught_up:
+                    return conn
+            
+            conn.close()
+            if lagging:
+                _replica_healthy_until = 0.0
+                _replica_lagging_until = time.monotonic() + REPLICA_LAG_CHECK_INTERVAL
+    
+    return psycopg2.connect(os.environ.get('DATABASE_URL'))
+
+def parse_fields(params: Dict[str, Any], allowed: tuple) -> Optional[tuple]:
+    requested = [field.strip() for field in (params.get('fields') or '').split(',')]
+    fields = tuple(field for field in requested if field in allowed)
+    return fields or None
+
+def project(rows: List[Dict[str, Any]], fields: Optional[tuple]) -> List[Dict[str, Any]]:
+    if not fields:
+        return rows
+    return [{field: row[field] for field in fields} for row in rows]
+
+def serialize_body(payload: Dict[str, Any]) -> bytes:
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def negotiate_encoding(event: Dict[str, Any]) -> Optional[str]:
+    headers = event.get('headers') or {}
+    accept = headers.get('Accept-Encoding') or headers.get('accept-encoding') or ''
+    
+    accepted = {}
+    for part in accept.split(','):
+        name, _, params = part.partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    
+    for encoding in ('br', 'gzip'):
+        if encoding == 'br' and brotli is None:
+            continue
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+def compress_body(raw: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(raw, quality=BROTLI_QUALITY)
+    return gzip.compress(raw, compresslevel=GZIP_LEVEL, mtime=0)
+
+def build_response(event: Dict[str, Any], body: bytes, variants: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    '''
+    Ответ 200 с JSON-телом, сжатым по Accept-Encoding (br/gzip), если тело больше порога
+    variants - кэш уже сжатых вариантов тела, дополняется при промахе
+    '''
+    headers = {
+        'Content-Type': 'application/json; charset=utf-8',
+        'Access-Control-Allow-Origin': '*',
+        'Vary': 'Accept-Encoding'
+    }
+    encoding = negotiate_encoding(event) if len(body) >= COMPRESSION_MIN_BYTES else None
+    
+    if not encoding:
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': body.decode('utf-8'),
+            'isBase64Encoded': False
+        }
+    
+    if variants is not None and encoding in variants:
+        encoded = variants[encoding]
+    else:
+        encoded = base64.b64encode(compress_body(body, encoding)).decode('ascii')
+        if variants is not None:
+            variants[encoding] = encoded
+    
+    headers['Content-Encoding'] = encoding
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': encoded,
+        'isBase64Encoded': True
+    }
+
 def get_products(event: Dict[str, Any]) -> Dict[str, Any]:
-    dsn = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(dsn)
+    params = event.get('queryStringParameters') or {}
+    category = params.get('category')
+    search = params.get('search')
+    fields = parse_fields(params, PRODUCT_FIELDS)
+    
+    cache_key = (category, search, fields)
+    cached = _catalog_cache.get(cache_key)
+    if cached and time.monotonic() - cached['created_at'] < CATALOG_CACHE_TTL:
+        return build_response(event, cached['body'], cached['variants'])
+    
+    conn = connect_for_read()
     cursor = conn.cursor()
     
     try:
-        params = event.get('queryStringParameters') or {}
-        category = params.get('category')
-        search = params.get('search')
-        
         query = "SELECT id, name, category, price, description, image_url, is_active FROM products WHERE is_active = TRUE"
         query_params = []
         
@@ -77,12 +236,17 @@ def get_products(event: Dict[str, Any]) -> Dict[str, Any]:
                 'is_active': p[6]
             })
         
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'products': result}),
-            'isBase64Encoded': False
+        if len(_catalog_cache) >= CATALOG_CACHE_MAX:
+            _catalog_cache.clear()
+        
+        cached = {
+            'created_at': time.monotonic(),
+            'body': serialize_body({'products': project(result, fields)}),
+            'variants': {}
         }
+        _catalog_cache[cache_key] = cached
+        
+        return build_response(event, cached['body'], cached['variants'])
     finally:
         cursor.close()
         conn.close()
@@ -192,6 +356,7 @@ def init_catalog() -> Dict[str, Any]:
                     product
                 )
             conn.commit()
+            _catalog_cache.clear()
             return {
                 'statusCode': 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
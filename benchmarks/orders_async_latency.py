@@ -0,0 +1,74 @@
+'''
+Бенчмарк задержек функции orders: синхронный путь (psycopg2) против асинхронного (asyncpg)
+Нужна БД со схемой из db_migrations и пользователь с товарами в корзине:
+DATABASE_URL=... JWT_SECRET=... python benchmarks/orders_async_latency.py --user-id 1
+'''
+import argparse
+import importlib.util
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_orders_module() -> Any:
+    # Ограничения частоты не должны влиять на замер
+    os.environ.setdefault('RATE_LIMIT_ORDERS_USER_PER_SECOND', '1000000')
+    os.environ.setdefault('RATE_LIMIT_ORDERS_USER_BURST', '1000000')
+    os.environ.setdefault('RATE_LIMIT_ORDERS_IP_PER_SECOND', '1000000')
+    os.environ.setdefault('RATE_LIMIT_ORDERS_IP_BURST', '1000000')
+    spec = importlib.util.spec_from_file_location('orders_index', os.path.join(ROOT, 'backend', 'orders', 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def make_event(user_id: int) -> Dict[str, Any]:
+    import jwt
+    token = jwt.encode({
+        'user_id': user_id,
+        'exp': datetime.utcnow() + timedelta(hours=1)
+    }, os.environ.get('JWT_SECRET', 'default_secret_key_change_me'), algorithm='HS256')
+    return {
+        'httpMethod': 'POST',
+        'headers': {'X-Auth-Token': token},
+        'body': json.dumps({'action': 'checkout'})
+    }
+
+def percentile(samples: List[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def run(orders: Any, event: Dict[str, Any], iterations: int, warmup: int) -> List[float]:
+    for _ in range(warmup):
+        orders.handler(event, None)
+
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        response = orders.handler(event, None)
+        samples.append((time.perf_counter() - started) * 1000)
+        if response['statusCode'] != 200:
+            raise SystemExit(f'Unexpected response: {response}')
+    return samples
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--user-id', type=int, required=True)
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--warmup', type=int, default=20)
+    args = parser.parse_args()
+
+    orders = load_orders_module()
+    event = make_event(args.user_id)
+
+    print(f'{"mode":<8}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+    for mode, use_async in (('sync', False), ('async', True)):
+        orders.ORDERS_ASYNC = use_async
+        samples = run(orders, event, args.iterations, args.warmup)
+        print(f'{mode:<8}{percentile(samples, 0.5):>10.2f}{percentile(samples, 0.95):>10.2f}'
+              f'{percentile(samples, 0.99):>10.2f}{max(samples):>10.2f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+'''
+Бенчмарк сжатия ответов каталога: байты в ответе и процессорное время на ответ
+Запуск: python benchmarks/response_compression.py [--rows 75] [--iterations 200]
+'''
+import argparse
+import base64
+import importlib.util
+import json
+import os
+import time
+from typing import Any, Callable, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CATEGORIES = [
+    ('telegram', 'Telegram {n} звезд', 'Звезды Telegram', '⭐'),
+    ('robux_gamepass', '{n} Робуксов (гейм пасс)', 'Робуксы через гейм пасс - ожидание 5 дней', '🎮'),
+    ('apple_gift', 'Apple/iTunes {n}₽ (RU)', 'Подарочная карта Apple Store и iTunes, регион Россия', '🍎'),
+    ('valorant', 'Valorant {n} VP (RU)', 'Валюта Valorant Points, регион Россия', '⚔️'),
+    ('spotify', 'Spotify Premium {n} месяцев', 'Подписка Spotify Premium Individual (оформление 10:00-18:00 МСК)', '🎵'),
+]
+
+def load_products_module() -> Any:
+    spec = importlib.util.spec_from_file_location('products_index', os.path.join(ROOT, 'backend', 'products', 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def make_catalog(rows: int) -> List[Dict[str, Any]]:
+    catalog = []
+    for i in range(rows):
+        category, name, description, image = CATEGORIES[i % len(CATEGORIES)]
+        catalog.append({
+            'id': i + 1,
+            'name': name.format(n=(i // len(CATEGORIES) + 1) * 50),
+            'category': category,
+            'price': float(100 + i * 10),
+            'description': description,
+            'image_url': image,
+            'is_active': True
+        })
+    return catalog
+
+def measure(iterations: int, build: Callable[[], Dict[str, Any]]) -> tuple:
+    response = build()
+    started = time.process_time()
+    for _ in range(iterations):
+        build()
+    cpu_ms = (time.process_time() - started) * 1000 / iterations
+    if response.get('isBase64Encoded'):
+        return len(base64.b64decode(response['body'])), cpu_ms
+    return len(response['body'].encode('utf-8')), cpu_ms
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=75)
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    products = load_products_module()
+    catalog = make_catalog(args.rows)
+    payload = {'products': catalog}
+    compact_fields = ('id', 'name', 'price')
+
+    def event(encoding: str) -> Dict[str, Any]:
+        return {'headers': {'Accept-Encoding': encoding}}
+
+    def cached(encoding: str, fields: Any = None) -> Callable[[], Dict[str, Any]]:
+        body = products.serialize_body({'products': products.project(catalog, fields)})
+        variants: Dict[str, str] = {}
+        products.build_response(event(encoding), body, variants)
+        return lambda: products.build_response(event(encoding), body, variants)
+
+    def cache_miss(encoding: str) -> Callable[[], Dict[str, Any]]:
+        # Новый ключ кэша (например, другой search): вариант сжимается и кладется в пустой кэш
+        body = products.serialize_body(payload)
+        return lambda: products.build_response(event(encoding), body, {})
+
+    cases = [
+        ('json.dumps (before)', lambda: {'body': json.dumps(payload)}),
+        ('compact identity', lambda: products.build_response(event('identity'), products.serialize_body(payload))),
+        ('gzip', lambda: products.build_response(event('gzip'), products.serialize_body(payload))),
+        ('br', lambda: products.build_response(event('br'), products.serialize_body(payload))),
+        ('gzip cache miss', cache_miss('gzip')),
+        ('br cache miss', cache_miss('br')),
+        ('gzip cached', cached('gzip')),
+        ('br cached', cached('br')),
+        ('fields=id,name,price identity', lambda: products.build_response(
+            event('identity'), products.serialize_body({'products': products.project(catalog, compact_fields)}))),
+        ('fields=id,name,price br cached', cached('br', compact_fields)),
+    ]
+
+    print(f'{"case":<34}{"bytes":>10}{"cpu ms/resp":>14}')
+    for name, build in cases:
+        if 'br' in name.split() and products.brotli is None:
+            print(f'{name:<34}{"brotli not installed":>24}')
+            continue
+        size, cpu_ms = measure(args.iterations, build)
+        print(f'{name:<34}{size:>10}{cpu_ms:>14.3f}')
+
+if __name__ == '__main__':
+    main()
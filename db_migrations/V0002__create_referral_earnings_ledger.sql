@@ -0,0 +1,16 @@
+-- У каждого пользователя может быть только один пригласивший
+CREATE UNIQUE INDEX IF NOT EXISTS idx_referrals_referred_id ON referrals(referred_id);
+CREATE INDEX IF NOT EXISTS idx_referrals_referrer_id ON referrals(referrer_id);
+
+-- Журнал реферальных начислений (только добавление записей)
+CREATE TABLE IF NOT EXISTS referral_earnings_ledger (
+    id SERIAL PRIMARY KEY,
+    referrer_id INTEGER NOT NULL REFERENCES users(id),
+    referred_id INTEGER NOT NULL REFERENCES users(id),
+    order_id INTEGER NOT NULL REFERENCES orders(id),
+    amount DECIMAL(10, 2) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(order_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_referral_earnings_ledger_referrer_id ON referral_earnings_ledger(referrer_id);
@@ -0,0 +1,132 @@
+-- Секционированные по месяцу created_at таблицы заказов.
+-- Заполняются фоновым переносом (действие migrate_orders в функции orders),
+-- после завершения переноса подменяют исходные orders и order_items.
+CREATE TABLE IF NOT EXISTS orders_partitioned (
+    id INTEGER NOT NULL DEFAULT nextval('orders_id_seq'),
+    user_id INTEGER REFERENCES users(id),
+    total_amount DECIMAL(10, 2) NOT NULL,
+    discount_amount DECIMAL(10, 2) DEFAULT 0,
+    final_amount DECIMAL(10, 2) NOT NULL,
+    payment_method VARCHAR(50) NOT NULL,
+    payment_status VARCHAR(50) DEFAULT 'pending',
+    status VARCHAR(50) DEFAULT 'pending',
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE IF NOT EXISTS order_items_partitioned (
+    id INTEGER NOT NULL DEFAULT nextval('order_items_id_seq'),
+    order_id INTEGER NOT NULL,
+    product_id INTEGER REFERENCES products(id),
+    product_name VARCHAR(255) NOT NULL,
+    product_price DECIMAL(10, 2) NOT NULL,
+    quantity INTEGER NOT NULL DEFAULT 1,
+    total_price DECIMAL(10, 2) NOT NULL,
+    order_created_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (id, order_created_at),
+    FOREIGN KEY (order_id, order_created_at) REFERENCES orders_partitioned(id, created_at)
+) PARTITION BY RANGE (order_created_at);
+
+CREATE TABLE IF NOT EXISTS orders_default PARTITION OF orders_partitioned DEFAULT;
+CREATE TABLE IF NOT EXISTS order_items_default PARTITION OF order_items_partitioned DEFAULT;
+
+CREATE INDEX IF NOT EXISTS idx_orders_user_id_created_at ON orders_partitioned(user_id, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_order_items_partitioned_order_id ON order_items_partitioned(order_id);
+
+-- Последовательности не должны удаляться вместе со старыми таблицами
+ALTER SEQUENCE orders_id_seq OWNED BY NONE;
+ALTER SEQUENCE order_items_id_seq OWNED BY NONE;
+
+-- Ссылка на секционированную таблицу возможна только по (id, created_at)
+ALTER TABLE referral_earnings_ledger DROP CONSTRAINT IF EXISTS referral_earnings_ledger_order_id_fkey;
+
+-- Месяц заказа в позициях нужен как ключ секционирования
+ALTER TABLE order_items ADD COLUMN IF NOT EXISTS order_created_at TIMESTAMP;
+CREATE INDEX IF NOT EXISTS idx_order_items_order_id ON order_items(order_id);
+
+-- Создание месячных секций orders и order_items
+CREATE OR REPLACE FUNCTION create_order_partitions(p_month DATE) RETURNS VOID AS $$
+DECLARE
+    month_start DATE := date_trunc('month', p_month)::date;
+    month_end DATE := (date_trunc('month', p_month) + INTERVAL '1 month')::date;
+    suffix TEXT := to_char(date_trunc('month', p_month), '"y"YYYY"m"MM');
+    orders_parent TEXT := COALESCE(to_regclass('orders_partitioned')::text, 'orders');
+    items_parent TEXT := COALESCE(to_regclass('order_items_partitioned')::text, 'order_items');
+BEGIN
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+        'orders_' || suffix, orders_parent, month_start, month_end
+    );
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+        'order_items_' || suffix, items_parent, month_start, month_end
+    );
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT create_order_partitions(m::date)
+FROM generate_series(
+    date_trunc('month', COALESCE((SELECT MIN(created_at) FROM orders), CURRENT_TIMESTAMP)),
+    date_trunc('month', CURRENT_TIMESTAMP + INTERVAL '2 months'),
+    INTERVAL '1 month'
+) AS m;
+
+-- Пока идет перенос, новые записи дублируются в секционированные таблицы
+CREATE OR REPLACE FUNCTION mirror_order_to_partitioned() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO orders_partitioned (id, user_id, total_amount, discount_amount, final_amount, payment_method, payment_status, status, created_at, updated_at)
+    VALUES (NEW.id, NEW.user_id, NEW.total_amount, NEW.discount_amount, NEW.final_amount, NEW.payment_method, NEW.payment_status, NEW.status, NEW.created_at, NEW.updated_at)
+    ON CONFLICT (id, created_at) DO UPDATE SET
+        user_id = EXCLUDED.user_id,
+        total_amount = EXCLUDED.total_amount,
+        discount_amount = EXCLUDED.discount_amount,
+        final_amount = EXCLUDED.final_amount,
+        payment_method = EXCLUDED.payment_method,
+        payment_status = EXCLUDED.payment_status,
+        status = EXCLUDED.status,
+        updated_at = EXCLUDED.updated_at;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION mirror_order_item_to_partitioned() RETURNS TRIGGER AS $$
+BEGIN
+    IF NEW.order_created_at IS NULL THEN
+        SELECT created_at INTO NEW.order_created_at FROM orders WHERE id = NEW.order_id;
+    END IF;
+    INSERT INTO order_items_partitioned (id, order_id, product_id, product_name, product_price, quantity, total_price, order_created_at)
+    VALUES (NEW.id, NEW.order_id, NEW.product_id, NEW.product_name, NEW.product_price, NEW.quantity, NEW.total_price, NEW.order_created_at)
+    ON CONFLICT (id, order_created_at) DO NOTHING;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_orders_mirror ON orders;
+CREATE TRIGGER trg_orders_mirror
+    AFTER INSERT OR UPDATE ON orders
+    FOR EACH ROW EXECUTE FUNCTION mirror_order_to_partitioned();
+
+DROP TRIGGER IF EXISTS trg_order_items_mirror ON order_items;
+CREATE TRIGGER trg_order_items_mirror
+    BEFORE INSERT ON order_items
+    FOR EACH ROW EXECUTE FUNCTION mirror_order_item_to_partitioned();
+
+-- Состояние фонового переноса
+CREATE TABLE IF NOT EXISTS orders_partition_migration (
+    id INTEGER PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    last_order_id INTEGER NOT NULL DEFAULT 0,
+    completed_at TIMESTAMP
+);
+
+INSERT INTO orders_partition_migration (id) VALUES (1) ON CONFLICT DO NOTHING;
+
+-- Архив старых заказов: сжатый gzip JSON по пользователю и месяцу
+CREATE TABLE IF NOT EXISTS orders_archive (
+    user_id INTEGER NOT NULL,
+    month DATE NOT NULL,
+    order_count INTEGER NOT NULL,
+    payload BYTEA NOT NULL,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, month)
+);
@@ -0,0 +1,19 @@
+-- Дневные агрегаты продаж по способу оплаты (только оплаченные заказы)
+CREATE TABLE IF NOT EXISTS sales_daily (
+    day DATE NOT NULL,
+    payment_method VARCHAR(50) NOT NULL,
+    orders_count INTEGER NOT NULL,
+    total_amount DECIMAL(12, 2) NOT NULL,
+    discount_amount DECIMAL(12, 2) NOT NULL,
+    final_amount DECIMAL(12, 2) NOT NULL,
+    PRIMARY KEY (day, payment_method)
+);
+
+-- Дневные агрегаты продаж по категориям товаров (выручка до скидки)
+CREATE TABLE IF NOT EXISTS sales_daily_category (
+    day DATE NOT NULL,
+    category VARCHAR(100) NOT NULL,
+    items_sold INTEGER NOT NULL,
+    gross_revenue DECIMAL(12, 2) NOT NULL,
+    PRIMARY KEY (day, category)
+);
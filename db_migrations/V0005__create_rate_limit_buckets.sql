@@ -0,0 +1,44 @@
+-- Общие для всех экземпляров функций ограничения частоты запросов (token bucket).
+-- UNLOGGED: состояние не критично и может быть потеряно при сбое
+CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit_buckets (
+    key VARCHAR(255) PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    updated_at TIMESTAMP NOT NULL
+);
+
+-- Забирает один токен из корзины p_key. Возвращает 0, если запрос разрешен,
+-- иначе число секунд до появления следующего токена
+CREATE OR REPLACE FUNCTION take_rate_limit_token(p_key TEXT, p_rate DOUBLE PRECISION, p_burst DOUBLE PRECISION)
+RETURNS DOUBLE PRECISION AS $$
+DECLARE
+    bucket_tokens DOUBLE PRECISION;
+    bucket_updated_at TIMESTAMP;
+    now_ts TIMESTAMP;
+BEGIN
+    INSERT INTO rate_limit_buckets (key, tokens, updated_at)
+    VALUES (p_key, p_burst, clock_timestamp())
+    ON CONFLICT (key) DO NOTHING;
+
+    SELECT tokens, updated_at INTO bucket_tokens, bucket_updated_at
+    FROM rate_limit_buckets
+    WHERE key = p_key
+    FOR UPDATE;
+
+    now_ts := clock_timestamp();
+    bucket_tokens := LEAST(p_burst, bucket_tokens + GREATEST(EXTRACT(EPOCH FROM now_ts - bucket_updated_at), 0) * p_rate);
+
+    -- Изредка удаляем давно не используемые корзины
+    IF random() < 0.001 THEN
+        DELETE FROM rate_limit_buckets WHERE updated_at < now_ts - INTERVAL '1 hour';
+    END IF;
+
+    IF bucket_tokens >= 1 THEN
+        UPDATE rate_limit_buckets SET tokens = bucket_tokens - 1, updated_at = now_ts WHERE key = p_key;
+        RETURN 0;
+    END IF;
+
+    UPDATE rate_limit_buckets SET tokens = bucket_tokens, updated_at = now_ts WHERE key = p_key;
+
+    RETURN (1 - bucket_tokens) / p_rate;
+END;
+$$ LANGUAGE plpgsql;